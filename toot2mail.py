@@ -4,6 +4,7 @@
 # of the MIT license.  See the LICENSE file for details.
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from datetime import datetime
 from email.header import Header
@@ -11,48 +12,83 @@ from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import COMMASPACE, formatdate
+from functools import cached_property
 from pathlib import Path
 from random import randint
-from time import sleep
-from urllib.parse import urljoin, urlsplit
+from string import Template
+from time import sleep, time
+from urllib.parse import urlsplit
+import fcntl
 import io
 import json
 import logging
 import logging.handlers
 import os
+import queue
 import re
 import smtplib
 import socket
+import struct
 import sys
 import textwrap
+import threading
 
-from PIL import Image, ImageDraw
-import markdownify
+from lxml import html as lxml_html
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import requests
 import urllib3
 
+try:
+    import ciso8601
+except ImportError:
+    ciso8601 = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyvips
+except ImportError:
+    pyvips = None
+
+
+def _json_loads(data):
+    # orjson parses the large timeline responses and the state file a few times
+    # faster than the stdlib json module, use it when it is available
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 
 HTTP_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; rv:128.0) Gecko/20100101 Firefox/128.0'
 CONFIG_FILENAME = '~/.config/toot2mail.conf'
-MAIL_MESSAGE_TEMPLATE = '''{toot}
-
-{card}{poll_text}
+NODEINFO_CACHE_TTL = 86400  # 24 hours, the instance software rarely changes
+IMAGE_MAXIMUM_DOWNLOAD_SIZE = 20 * 1024 * 1024  # refuse to download larger images
+RATE_LIMIT_MINIMUM_REMAINING = 20  # start spreading requests below this budget
+CACHE_MISS = object()  # sentinel for cache lookups, compared by identity
+# parsed once at module load, str.format() would re-parse the template per toot
+MAIL_MESSAGE_TEMPLATE = Template('''${toot}
+
+${card}${poll_text}
 --------------------------------
-Videos: {videos}
-Posted by: {posted_by}
-Boosted by: {boosted_by}
-Application: {application}
-
-In Reply To: {in_reply_to_url}
-URL: {url}
-Timeline: https://{hostname}/@{username}/with_replies
-Toot ID: {toot_id}
-'''
-
-CARD_TEMPLATE = '''
+Videos: ${videos}
+Posted by: ${posted_by}
+Boosted by: ${boosted_by}
+Application: ${application}
+
+In Reply To: ${in_reply_to_url}
+URL: ${url}
+Timeline: https://${hostname}/@${username}/with_replies
+Toot ID: ${toot_id}
+''')
+
+CARD_TEMPLATE = Template('''
 --------------------------------
-Card URL:   {card_url}
-Card Title: {card_title}'''
+Card URL:   ${card_url}
+Card Title: ${card_title}''')
 
 
 INCOMPATIBLE_ACTIVITY_PUB_INSTANCES = (
@@ -74,9 +110,12 @@ INCOMPATIBLE_ACTIVITY_PUB_INSTANCES = (
 # (https://github.com/halcy/Mastodon.py/blob/master/mastodon/types_base.py)
 class AttribAccessDict(dict):
     def __getattr__(self, attr):
-        if attr in self:
+        # single dict lookup instead of a containment check plus lookup,
+        # attribute access is the hot path for all toot processing
+        try:
             return self[attr]
-        raise AttributeError('Attribute not found: ' + str(attr))
+        except KeyError as exc:
+            raise AttributeError('Attribute not found: ' + str(attr)) from exc
 
     def __setattr__(self, attr, val):
         if attr in self:
@@ -110,47 +149,59 @@ class Toot(AttribAccessDict):
         else:
             self.is_boost = False
 
-    @property
+    # the accessors below are cached properties as they are read multiple times
+    # per toot and would otherwise wrap their payload in new objects on each access
+    @cached_property
     def application(self):
         application = self.get('application')
         return AttribAccessDict(application or {})
 
-    @property
+    @cached_property
     def content(self):
-        content = self.get('content')
-        spoiler_text = self.get('spoiler_text')
-        if spoiler_text:
-            return f'{spoiler_text}\n\n{content}'
+        # the spoiler text is plain text and joined to the extracted text in
+        # _factor_text_content, mixed into the HTML it would get lost there
+        return self.get('content')
 
-        return content
-
-    @property
+    @cached_property
     def card(self):
         card = self.get('card')
         return AttribAccessDict(card or {})
 
-    @property
+    @cached_property
     def poll(self):
         poll = self.get('poll')
         return AttribAccessDict(poll or {})
 
-    @property
+    @cached_property
     def account(self):
         account = self.get('account')
         return AttribAccessDict(account or {})
 
     def get_hostname(self):
-        parsed_url = urlsplit(self.url)
-        return parsed_url.netloc
+        # cache the parsed hostname in the dict, it is queried multiple times per toot
+        hostname = self.get('_hostname')
+        if hostname is None:
+            parsed_url = urlsplit(self.url)
+            hostname = parsed_url.netloc
+            self['_hostname'] = hostname
+
+        return hostname
 
     def get_uid(self):
+        uid = self.get('_uid')
+        if uid is not None:
+            return uid
+
         acct = self.account.acct
         if '@' in acct:
-            return acct.lower()
+            uid = acct.lower()
+        else:
+            username_lowercase = self.account.username.lower()
+            hostname_lowercase = self.get_hostname().lower()
+            uid = f'{username_lowercase}@{hostname_lowercase}'
 
-        username_lowercase = self.account.username.lower()
-        hostname_lowercase = self.get_hostname().lower()
-        return f'{username_lowercase}@{hostname_lowercase}'
+        self['_uid'] = uid
+        return uid
 
     def get_username(self, compound=True):
         if self.boosted_by_toot is not None and compound:
@@ -168,7 +219,7 @@ class Toot(AttribAccessDict):
 
         return display_name
 
-    @property
+    @cached_property
     def media_attachments(self):
         media_attachments = self.get('media_attachments') or []
         return [AttribAccessDict(media_attachment) for media_attachment in media_attachments]
@@ -183,6 +234,7 @@ class MastodonEmailProcessor:
         self._timeline_limit = None
         self._state_file_path = None
         self._lock_file_path = None
+        self._lock_file = None
         self._image_maximum_size = None
         self._mail_maximum_subject_length = None
         self._mail_from = None
@@ -194,18 +246,37 @@ class MastodonEmailProcessor:
         self._hashtags = None
         self._references = None
         self._toot_state = None
-        self._content_replacements = {}
+        self._state_maximum_toots_per_user = None
+        self._content_replacements = []
         self._cache = {}  # simple local instance cache for HTTP requests
+        self._original_toot_cache = {}  # resolved originating instance toots keyed by URI
+        self._ratelimits = {}  # hostname -> (remaining, reset timestamp) from response headers
+        self._session = None
+        self._toot_state_lock = threading.Lock()
+        self._toot_state_dirty = False
+        self._journal_file_path = None
+        self._journal_file = None
+        self._nodeinfo_cache = None
+        self._nodeinfo_cache_path = None
+        self._nodeinfo_cache_dirty = False
+        self._nodeinfo_cache_lock = threading.Lock()
+        self._smtp = None
+        self._mail_queue = None
+        self._mail_worker_thread = None
+        self._mail_delivery_errors = 0
+        self._pending_last_toot_ids = []
 
     def process(self, toot_reference=None, tag_reference=None, user_reference=None,
                 thread_reference=None):
         self._setup_config()
+        self._setup_http_session()
         self._setup_logger()
         self._log_hello()
-        self._assert_not_already_running()
-        self._write_lock()
+        self._acquire_lock()
+        self._start_mail_worker()
 
         self._read_toot_state()
+        self._read_nodeinfo_cache()
         try:
             if toot_reference:
                 self._process_single_toot(toot_reference)
@@ -218,18 +289,45 @@ class MastodonEmailProcessor:
                 hostname, username = self._parse_user_reference(user_reference)
                 self._process_user(username, hostname, exclude_replies=False, exclude_boosts=False)
             else:
-                for username, hostname, exclude_replies, exclude_boosts in self._usernames:
-                    self._process_user(username, hostname, exclude_replies, exclude_boosts)
-                    self._pause()
-                for hashtag, hostname in self._hashtags:
-                    self._process_hashtag(hashtag, hostname)
-                    self._pause()
+                self._process_timelines()
         finally:
+            self._stop_mail_worker()
+            self._apply_pending_last_toot_ids()
             self._write_toot_state()
-            self._remove_lock()
+            self._write_nodeinfo_cache()
+            self._release_lock()
+            self._close_smtp_connection()
+            self._session.close()
 
         self._log_farewell()
 
+    def _process_timelines(self):
+        # group the configured accounts and hashtags by instance: distinct instances do not
+        # share rate limits and can be processed in parallel, jobs on the same instance are
+        # still processed sequentially with a pause in between
+        jobs_by_hostname = {}
+        for username, hostname, exclude_replies, exclude_boosts in self._usernames:
+            jobs_by_hostname.setdefault(hostname, []).append(
+                (self._process_user, (username, hostname, exclude_replies, exclude_boosts)))
+        for hashtag, hostname in self._hashtags:
+            jobs_by_hostname.setdefault(hostname, []).append(
+                (self._process_hashtag, (hashtag, hostname)))
+
+        if not jobs_by_hostname:
+            return
+
+        max_workers = min(8, len(jobs_by_hostname))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in executor.map(self._process_jobs_for_hostname,
+                                  jobs_by_hostname.keys(), jobs_by_hostname.values()):
+                pass  # consume the iterator to propagate any errors
+
+    def _process_jobs_for_hostname(self, hostname, jobs):
+        for job_no, (process_func, args) in enumerate(jobs):
+            if job_no > 0:
+                self._pause(hostname)
+            process_func(*args)
+
     def _setup_config(self):
         config_parser = ConfigParser(allow_no_value=True, delimiters=('=',))
         # read config file from location as specified via command line but fail it if doesn't exist
@@ -239,7 +337,12 @@ class MastodonEmailProcessor:
 
         self._timeout = config_parser.getfloat('settings', 'timeout', fallback=60)
         self._timeline_limit = config_parser.get('settings', 'timeline_limit')
+        # remember a multiple of the timeline window per user, older toots can
+        # never be returned by the API again and would only bloat the state file
+        self._state_maximum_toots_per_user = max(int(self._timeline_limit) * 4, 200)
         self._state_file_path = Path(config_parser.get('settings', 'state_file_path'))
+        self._nodeinfo_cache_path = self._state_file_path.with_suffix('.nodeinfo.json')
+        self._journal_file_path = self._state_file_path.with_suffix('.journal.jsonl')
         self._lock_file_path = Path(config_parser.get('settings', 'lock_file_path'))
         self._mail_maximum_subject_length = config_parser.getint(
             'settings', 'mail_maximum_subject_length')
@@ -252,8 +355,9 @@ class MastodonEmailProcessor:
         if image_maximum_size:
             self._image_maximum_size = [int(value) for value in image_maximum_size.split(',')]
 
+        # compile the patterns once, they are applied to every toot body and card URL
         for regex, replacement in config_parser.items('content_replacement', raw=True):
-            self._content_replacements[regex] = replacement
+            self._content_replacements.append((re.compile(regex), replacement))
 
         proxy = config_parser.get('settings', 'proxy')
         if proxy:
@@ -274,6 +378,22 @@ class MastodonEmailProcessor:
             hashtag, hostname = uid.split('@')
             self._hashtags.append((hashtag, hostname))
 
+    def _setup_http_session(self):
+        # reuse one session for all HTTP requests to benefit from Keep-Alive and
+        # connection pooling instead of doing a new TCP+TLS handshake per request
+        adapter = HTTPAdapter(
+            pool_connections=32, pool_maxsize=32,
+            # raise_on_status=False returns the last response once the retries are
+            # exhausted so raise_for_status() raises the usual HTTPError instead
+            # of a RetryError which no caller handles
+            max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=(502, 503, 504),
+                              raise_on_status=False))
+        self._session = requests.Session()
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._session.headers.update({'User-Agent': HTTP_USER_AGENT})
+        self._session.proxies = self._proxies
+
     def _setup_logger(self):
         me = Path(__file__).name
         log_format = '[%(levelname)+8s] [%(process)-8s] [%(name)-30s] %(message)s'
@@ -287,14 +407,18 @@ class MastodonEmailProcessor:
 
         self._logger = logging.getLogger(me)
 
-    def _assert_not_already_running(self):
-        if self._lock_file_path.exists():
+    def _acquire_lock(self):
+        # an advisory lock is atomic and released by the kernel when the process dies,
+        # unlike the previous existence check which raced and left stale lock files
+        self._lock_file = open(self._lock_file_path, 'w', encoding='utf-8')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
             msg = 'Already running. Aborting.'
             self._logger.info(msg)
-            raise RuntimeError(msg)
-
-    def _write_lock(self):
-        self._lock_file_path.touch()
+            raise RuntimeError(msg) from None
 
     def _log_hello(self):
         self._logger.info('Starting...')
@@ -306,8 +430,41 @@ class MastodonEmailProcessor:
         if not self._state_file_path.exists():
             self._toot_state = {}
         else:
-            with open(self._state_file_path, encoding='utf-8') as state_file:
-                self._toot_state = json.load(state_file)
+            self._toot_state = _json_loads(self._state_file_path.read_bytes())
+            # keep the toot URIs as sets in memory for fast membership tests
+            for user in self._toot_state.values():
+                user['toots'] = set(user.get('toots', []))
+
+        self._replay_toot_state_journal()
+
+    def _replay_toot_state_journal(self):
+        # re-apply toots which were already mailed in a run that crashed before
+        # its final state write, so they are not mailed again
+        if not self._journal_file_path.exists():
+            return
+
+        with open(self._journal_file_path, encoding='utf-8') as journal_file:
+            for line in journal_file:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = _json_loads(line)
+                user = self._toot_state.setdefault(entry['uid'], {'toots': set()})
+                user['toots'].add(entry['uri'])
+                self._toot_state_dirty = True
+
+    def _read_nodeinfo_cache(self):
+        if not self._nodeinfo_cache_path.exists():
+            self._nodeinfo_cache = {}
+        else:
+            self._nodeinfo_cache = _json_loads(self._nodeinfo_cache_path.read_bytes())
+
+    def _write_nodeinfo_cache(self):
+        if not self._nodeinfo_cache_dirty:
+            return
+
+        with open(self._nodeinfo_cache_path, 'w', encoding='utf-8') as cache_file:
+            json.dump(self._nodeinfo_cache, cache_file, indent=2)
 
     def _process_single_toot(self, toot_reference):
         # try to parse the toot reference as URL, otherwise expect it as toot_id@instance.tld
@@ -412,6 +569,7 @@ class MastodonEmailProcessor:
 
             toots_count = 0
             skipped_toots_count = 0
+            had_errors = False
             toots = self._get_toots(username, hostname)
 
             for toot in toots:
@@ -427,6 +585,13 @@ class MastodonEmailProcessor:
                 processed = self._process_toot(toot)
                 if processed:
                     toots_count += 1
+                elif processed is None:
+                    had_errors = True
+
+            # defer advancing the since_id window until the mail worker confirmed
+            # the deliveries, otherwise failed toots would never be retried
+            if toots and not had_errors:
+                self._pending_last_toot_ids.append((username, hostname, toots))
 
             self._logger.info(
                 'Processed %s new toot(s) and skipped %s already processed toot(s) for "%s@%s"',
@@ -454,14 +619,64 @@ class MastodonEmailProcessor:
 
     def _get_toots(self, username, hostname):
         account_id = self._get_account_id(username, hostname)
+        uid = f'{username.lower()}@{hostname.lower()}'
+        with self._toot_state_lock:
+            last_id = self._toot_state.get(uid, {}).get('last_id')
+
+        query_params = {'limit': self._timeline_limit}
+        if last_id:
+            # only request toots newer than what earlier runs fully processed, which
+            # shrinks the response to the delta for rarely posting accounts
+            query_params['since_id'] = last_id
+
         url = f'api/v1/accounts/{account_id}/statuses'
-        toot_dicts = self._request(url, hostname, query_params={'limit': self._timeline_limit})
+        toot_dicts = self._request(url, hostname, query_params=query_params)
         toots = [Toot(toot_dict) for toot_dict in toot_dicts]
         return toots
 
+    def _update_last_toot_id(self, username, hostname, toots):
+        try:
+            last_id = str(max(int(toot.id) for toot in toots))
+        except (TypeError, ValueError):
+            return  # non-numeric status ids, a since_id window cannot be used
+
+        uid = f'{username.lower()}@{hostname.lower()}'
+        with self._toot_state_lock:
+            user = self._toot_state.setdefault(uid, {'toots': set()})
+            user['last_id'] = last_id
+            self._toot_state_dirty = True
+
+    def _apply_pending_last_toot_ids(self):
+        # called after the mail worker drained its queue: advance the since_id
+        # windows only if every queued mail was actually delivered, otherwise
+        # the undelivered toots would be excluded from all future fetches
+        if self._mail_delivery_errors:
+            self._logger.warning(
+                '%s mail(s) could not be delivered, not advancing any since_id windows',
+                self._mail_delivery_errors)
+            return
+
+        for username, hostname, toots in self._pending_last_toot_ids:
+            self._update_last_toot_id(username, hostname, toots)
+        self._pending_last_toot_ids = []
+
     def _get_account_id(self, username, hostname):
+        # account ids never change, remember them in the state file to save
+        # one lookup API call per account and run
+        uid = f'{username.lower()}@{hostname.lower()}'
+        with self._toot_state_lock:
+            account_id = self._toot_state.get(uid, {}).get('account_id')
+        if account_id:
+            return account_id
+
         account = self._request('api/v1/accounts/lookup', hostname, query_params={'acct': username})
-        return account['id']
+        account_id = account['id']
+        with self._toot_state_lock:
+            user = self._toot_state.setdefault(uid, {'toots': set()})
+            user['account_id'] = account_id
+            self._toot_state_dirty = True
+
+        return account_id
 
     def _request(self, api_endpoint, hostname, query_params=None, url=None):
         if not hostname and not url:
@@ -469,32 +684,82 @@ class MastodonEmailProcessor:
             raise ValueError(msg)
 
         cache_key = (url, str(query_params)) if url else (hostname, api_endpoint, str(query_params))
-        result = self._cache.get(cache_key, '__no_cache_result__')
-        if result != '__no_cache_result__':
+        result = self._cache.get(cache_key, CACHE_MISS)
+        if result is not CACHE_MISS:
             return result
 
         if not url:
-            url = urljoin(f'https://{hostname}', api_endpoint)
+            # the API endpoints are always host relative, no need for a full urljoin()
+            url = f'https://{hostname}/{api_endpoint.lstrip("/")}'
 
-        response = requests.get(url, params=query_params, proxies=self._proxies,
-                                timeout=self._timeout,
-                                headers={'User-Agent': HTTP_USER_AGENT})
+        ratelimit_hostname = hostname or urlsplit(url).netloc
+        self._pace(ratelimit_hostname)
+        response = self._session.get(url, params=query_params, timeout=self._timeout)
+        if response.status_code == requests.status_codes.codes.TOO_MANY_REQUESTS:
+            self._wait_for_rate_limit_reset(ratelimit_hostname, response)
+            response = self._session.get(url, params=query_params, timeout=self._timeout)
+
+        self._update_rate_limit(ratelimit_hostname, response)
         response.raise_for_status()
 
-        response_json = response.json()
+        response_json = _json_loads(response.content)
         self._cache[cache_key] = response_json
         return response_json
 
+    def _pace(self, hostname):
+        # spread the remaining requests over the window when the budget gets low
+        # instead of running into the limit
+        ratelimit = self._ratelimits.get(hostname)
+        if not ratelimit:
+            return
+
+        remaining, reset_timestamp = ratelimit
+        if remaining >= RATE_LIMIT_MINIMUM_REMAINING:
+            return
+
+        delay = (reset_timestamp - time()) / max(remaining, 1)
+        if delay > 0:
+            self._logger.info('Rate limit budget low on "%s", waiting %.1f seconds',
+                              hostname, delay)
+            sleep(min(delay, 300))
+
+    def _wait_for_rate_limit_reset(self, hostname, response):
+        ratelimit = self._parse_rate_limit_headers(response)
+        delay = (ratelimit[1] - time()) if ratelimit else 60
+        delay = min(max(delay, 1), 300)
+        self._logger.warning('Rate limited on "%s", waiting %.0f seconds', hostname, delay)
+        sleep(delay)
+
+    def _update_rate_limit(self, hostname, response):
+        ratelimit = self._parse_rate_limit_headers(response)
+        if ratelimit:
+            self._ratelimits[hostname] = ratelimit
+
+    @staticmethod
+    def _parse_rate_limit_headers(response):
+        try:
+            remaining = int(response.headers.get('X-RateLimit-Remaining'))
+            reset_raw = response.headers.get('X-RateLimit-Reset')
+            if reset_raw.endswith('Z') and sys.version_info < (3, 11):
+                reset_raw = reset_raw[:-1]  # strip TZ info, Python < 3.11 cannot handle it
+            reset_timestamp = datetime.fromisoformat(reset_raw).timestamp()
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+        return remaining, reset_timestamp
+
     def _is_toot_already_processed(self, toot):
         uid = toot.get_uid()
         toot_uri = toot.uri.lower()
-        user = self._toot_state.get(uid, {})
-        user_toots = user.get('toots', [])
-        return bool(toot_uri in user_toots)
+        with self._toot_state_lock:
+            user = self._toot_state.get(uid, {})
+            user_toots = user.get('toots', set())
+            return bool(toot_uri in user_toots)
 
     def _process_toot(self, toot):
         self._references = set()
         try:
+            boost_toot = toot if toot.is_boost and toot.reblog is not None else None
             toot = self._get_toot_reblog(toot)
 
             # re-request the toot from the originating instance to get their account and status ids
@@ -513,18 +778,34 @@ class MastodonEmailProcessor:
             toot_timestamp = self._factor_toot_timestamp(toot)
             attachments = self._factor_toot_attachments(toot)
             headers = self._factor_mail_headers(toot)
-            # send the mail
-            self._send_mail(mail_from, subject, message, toot_timestamp, attachments, headers)
-            # remember toot
-            self._add_toot_to_toot_state(toot)
+            # send the mail; the worker remembers the toots once delivery succeeded
+            toots_to_remember = [toot] if boost_toot is None else [toot, boost_toot]
+            self._send_mail(toots_to_remember, mail_from, subject, message, toot_timestamp,
+                            attachments, headers)
         except Exception as exc:
             self._log_error(exc, 'An error occurred while processing "%s@%s" at toot %s: %s',
                             toot.account.username, toot.get_hostname(), toot.id, exc)
-            return False
+            # None (still falsy) tells the caller the toot failed rather than being
+            # skipped as already processed
+            return None
 
         return True
 
     def _get_toot_instance_type(self, hostname):
+        with self._nodeinfo_cache_lock:
+            entry = self._nodeinfo_cache.get(hostname)
+            if entry and time() - entry[2] < NODEINFO_CACHE_TTL:
+                return entry[0], entry[1]
+
+        software_name, software_version = self._query_nodeinfo(hostname)
+        if software_name is not None:
+            with self._nodeinfo_cache_lock:
+                self._nodeinfo_cache[hostname] = [software_name, software_version, time()]
+                self._nodeinfo_cache_dirty = True
+
+        return software_name, software_version
+
+    def _query_nodeinfo(self, hostname):
         nodeinfo_url = None
         try:
             response = self._request('.well-known/nodeinfo', hostname)
@@ -557,11 +838,27 @@ class MastodonEmailProcessor:
         if not self._can_toot_be_processed(toot):
             return toot
 
+        # different instance local copies of the same toot resolve to the same original,
+        # reply chains within a hashtag result set often hit the same origin repeatedly
+        cached_toot = self._original_toot_cache.get(toot.uri)
+        if cached_toot is not None:
+            original = Toot(cached_toot, boosted_by_toot=toot.boosted_by_toot)
+            # carry over an already resolved reply chain link, the fresh Toot copy
+            # would otherwise make each ancestor request its own context again
+            original.in_reply_to = toot.in_reply_to
+            return original
+
         originating_hostname, originating_toot_id = self._parse_hostname_and_toot_id_from_url(
             toot.url)
         try:
             new_toot = self._request(f'api/v1/statuses/{originating_toot_id}', originating_hostname)
-            return Toot(new_toot, boosted_by_toot=toot.boosted_by_toot)
+            self._original_toot_cache[toot.uri] = new_toot
+            # also key by the originating URI so re-resolving an already
+            # resolved toot is a cache hit instead of another request
+            self._original_toot_cache[new_toot.get('uri', toot.uri)] = new_toot
+            original = Toot(new_toot, boosted_by_toot=toot.boosted_by_toot)
+            original.in_reply_to = toot.in_reply_to
+            return original
         except (urllib3.exceptions.MaxRetryError, requests.exceptions.ProxyError) as exc:
             self._logger.info('Originating toot with ID "%s" on instance "%s" could '
                               'not be retrieved: %s',
@@ -603,39 +900,59 @@ class MastodonEmailProcessor:
         return True
 
     def _get_toot_in_reply_to(self, toot):
-        if toot.in_reply_to_id:
-            if not self._can_toot_be_processed(toot):
-                return
-
-            try:
-                in_reply_to = self._request(f'api/v1/statuses/{toot.in_reply_to_id}',
-                                            toot.get_hostname())
-            except requests.exceptions.HTTPError as exc:
-                # ignore 404 errors, sometimes toots might get deleted
-                if exc.response.status_code == 404:
-                    self._logger.info('Toot reply "%s" could not be found on server (404): %s',
-                                      toot.in_reply_to_id, exc)
-                    return
-                # raise for all other errors
-                raise
-
-            if in_reply_to:
-                toot.in_reply_to = Toot(in_reply_to, boosted_by_toot=toot.boosted_by_toot)
+        if not toot.in_reply_to_id or toot.in_reply_to is not None:
+            return
+        if not self._can_toot_be_processed(toot):
+            return
 
-                # re-request the toot from the originating instance to get account and status ids
-                if self._can_toot_be_processed(toot.in_reply_to):
-                    toot.in_reply_to = self._get_original_toot(toot.in_reply_to)
+        # the context endpoint returns all ancestors of the thread in a single request
+        # instead of one request per parent
+        try:
+            context = self._request(f'api/v1/statuses/{toot.id}/context', toot.get_hostname())
+        except requests.exceptions.HTTPError as exc:
+            # ignore 404 errors, sometimes toots might get deleted
+            if exc.response.status_code == 404:
+                self._logger.info('Toot context for "%s" could not be found on server (404): %s',
+                                  toot.id, exc)
+                return
+            # raise for all other errors
+            raise
+
+        # ancestors are ordered oldest first, build the chain starting at the direct parent
+        ancestors = context.get('ancestors') or []
+        reply_chain = [Toot(ancestor, boosted_by_toot=toot.boosted_by_toot)
+                       for ancestor in reversed(ancestors)]
+        if not reply_chain:
+            return
+
+        # re-request the toots from their originating instances in parallel
+        # to get their account and status ids
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            reply_chain = list(executor.map(self._get_original_toot_if_processable, reply_chain))
+
+        # link the chain so the mails can reference their parents and no ancestor
+        # triggers another chain walk when it is processed below
+        toot.in_reply_to = reply_chain[0]
+        for child, parent in zip(reply_chain, reply_chain[1:]):
+            child.in_reply_to = parent
+
+        # process the ancestors, oldest first
+        for ancestor in reversed(reply_chain):
+            if not self._is_toot_already_processed(ancestor):
+                self._process_toot(ancestor)
+
+    def _get_original_toot_if_processable(self, toot):
+        if self._can_toot_be_processed(toot):
+            return self._get_original_toot(toot)
 
-                if not self._is_toot_already_processed(toot.in_reply_to):
-                    self._process_toot(toot.in_reply_to)
+        return toot
 
     def _get_toot_reblog(self, toot):
         if toot.is_boost:
             if toot.reblog is None:
                 return toot
-            # remember toot from user who boosted it
-            self._add_toot_to_toot_state(toot)
-            # replace toot with the boosted one
+            # replace toot with the boosted one; the boosting toot is remembered
+            # together with it once the mail was delivered
             return Toot(toot.reblog, boosted_by_toot=toot)
 
         return toot
@@ -658,7 +975,7 @@ class MastodonEmailProcessor:
         else:
             application = '-'
 
-        message = MAIL_MESSAGE_TEMPLATE.format(
+        message = MAIL_MESSAGE_TEMPLATE.substitute(
             toot=text_content,
             username=toot.account.username,
             posted_by=posted_by,
@@ -688,7 +1005,7 @@ class MastodonEmailProcessor:
         card = toot.card
         if card:
             card_url = self._perform_content_replacements(card.url)
-            return CARD_TEMPLATE.format(card_url=card_url, card_title=card.title)
+            return CARD_TEMPLATE.substitute(card_url=card_url, card_title=card.title)
 
         return ''
 
@@ -718,6 +1035,9 @@ Poll ({poll.votes_count} votes so far, expires at {expires_at}):
 
     def _factor_text_content(self, toot):
         text_content = self._html2text(toot.content)
+        spoiler_text = toot.get('spoiler_text')
+        if spoiler_text:
+            text_content = f'{spoiler_text}\n\n{text_content}'
         text_content = self._perform_content_replacements(text_content)
 
         return text_content
@@ -726,19 +1046,34 @@ Poll ({poll.votes_count} votes so far, expires at {expires_at}):
         if not html:
             return html
 
-        return markdownify.markdownify(html, strip=['a'], escape_misc=False,
-                                       escape_asterisks=False, escape_underscores=False).strip()
+        # toot HTML is a small known subset (<p>, <br>, <a>, <span>), so extract the text
+        # directly with lxml instead of a full HTML to Markdown conversion, links are
+        # reduced to their text content
+        tree = lxml_html.fromstring(html)
+        for line_break in tree.iter('br'):
+            line_break.tail = '\n' + (line_break.tail or '')
+
+        paragraphs = [paragraph.text_content() for paragraph in tree.iter('p')]
+        if not paragraphs:
+            paragraphs = [tree.text_content()]
+
+        return '\n\n'.join(paragraphs).strip()
 
     def _perform_content_replacements(self, content):
         if not content:
             return content
 
-        for pattern, replacement in self._content_replacements.items():
-            content = re.sub(pattern, replacement, content)
+        for pattern, replacement in self._content_replacements:
+            content = pattern.sub(replacement, content)
 
         return content
 
     def _factor_toot_timestamp(self, toot):
+        if ciso8601 is not None:
+            # ciso8601 parses the timestamp much faster and handles the trailing 'Z'
+            # on all Python versions
+            return ciso8601.parse_datetime(toot.created_at).timestamp()
+
         toot_created_at = toot.created_at
         if toot_created_at.endswith('Z') and sys.version_info < (3, 11):
             toot_created_at = toot_created_at[:-1]  # strip TZ info, Python < 3.11 cannot handle it
@@ -747,14 +1082,13 @@ Poll ({poll.votes_count} votes so far, expires at {expires_at}):
         return created_at.timestamp()
 
     def _factor_toot_attachments(self, toot):
-        attachments = []
         hostname = toot.get_hostname()
+        image_jobs = []
         # card image
         card = toot.card
         if card and card.image:
             file_name = f'card_{Path(card.image).name}'
-            file_name, file_content = self._get_image(card.image, file_name, hostname)
-            attachments.append((file_name, file_content))
+            image_jobs.append((card.image, file_name))
 
         # media attachments
         for media in toot.media_attachments:
@@ -762,22 +1096,26 @@ Poll ({poll.votes_count} votes so far, expires at {expires_at}):
                 continue
 
             media_url = media.url if media.type == 'image' else media.preview_url
+            image_jobs.append((media_url, Path(media_url).name))
+
+        if not image_jobs:
+            return []
 
-            file_name = Path(media_url).name
-            file_name, file_content = self._get_image(media_url, file_name, hostname)
-            attachments.append((file_name, file_content))
+        # download the images in parallel, the shared session is thread-safe for GET requests
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            attachments = list(executor.map(
+                lambda job: self._get_image(job[0], job[1], hostname), image_jobs))
 
         return attachments
 
     def _get_image(self, image_url, file_name, hostname):
         self._logger.info('Retrieve image "%s"', image_url)
         try:
-            response = requests.get(image_url, proxies=self._proxies, timeout=self._timeout,
-                                    headers={'User-Agent': HTTP_USER_AGENT,
-                                             'Referer': f'https://{hostname}'})
-
-            response.raise_for_status()
-        except requests.exceptions.HTTPError as err:
+            with self._session.get(image_url, stream=True, timeout=self._timeout,
+                                   headers={'Referer': f'https://{hostname}'}) as response:
+                response.raise_for_status()
+                image_data = self._read_image_data(response)
+        except (requests.exceptions.HTTPError, ValueError) as err:
             msg = f'Unable to download image "{image_url}": {err}'
             self._logger.warning(msg)
             # generate an image containing the error message to indicate there was
@@ -785,11 +1123,32 @@ Poll ({poll.votes_count} votes so far, expires at {expires_at}):
             image_data = self._generate_download_error_image(msg)
             file_name = f'{file_name}.png'
         else:
-            image_data = self._downscale_image(response.content)
+            image_data = self._downscale_image(image_data)
 
         return file_name, image_data
 
+    def _read_image_data(self, response):
+        # stream the body so a misbehaving server cannot make us hold
+        # an arbitrarily large image in memory
+        msg = f'image exceeds the download limit of {IMAGE_MAXIMUM_DOWNLOAD_SIZE} bytes'
+        content_length = int(response.headers.get('Content-Length') or 0)
+        if content_length > IMAGE_MAXIMUM_DOWNLOAD_SIZE:
+            raise ValueError(msg)
+
+        chunks = []
+        received_bytes = 0
+        for chunk in response.iter_content(chunk_size=65536):
+            received_bytes += len(chunk)
+            if received_bytes > IMAGE_MAXIMUM_DOWNLOAD_SIZE:
+                raise ValueError(msg)
+            chunks.append(chunk)
+
+        return b''.join(chunks)
+
     def _generate_download_error_image(self, text):
+        # Pillow is imported lazily, most runs never touch an image
+        from PIL import Image, ImageDraw  # noqa: PLC0415
+
         if self._image_maximum_size:
             width = self._image_maximum_size[0]
             height = self._image_maximum_size[1]
@@ -798,12 +1157,11 @@ Poll ({poll.votes_count} votes so far, expires at {expires_at}):
             height = 300
 
         max_text_width = int(width / 10)
-        wrapped_text = textwrap.wrap(text, width=max_text_width)
+        wrapped_text = '\n'.join(textwrap.wrap(text, width=max_text_width))
 
         image = Image.new(mode='RGB', size=(width, height), color='lightgrey')
         draw = ImageDraw.Draw(image)
-        for i, line in enumerate(wrapped_text):
-            draw.text((25, 25 + (i * 20)), line, fill='black')
+        draw.multiline_text((25, 25), wrapped_text, fill='black', spacing=6)
 
         result = io.BytesIO()
         image.save(result, 'PNG')
@@ -815,11 +1173,35 @@ Poll ({poll.votes_count} votes so far, expires at {expires_at}):
 
         max_width = self._image_maximum_size[0]
         max_height = self._image_maximum_size[1]
+        # many preview images are already small enough, skip the whole
+        # Pillow decode/encode cycle for them
+        dimensions = self._peek_image_dimensions(image_data)
+        if dimensions and dimensions[0] <= max_width and dimensions[1] <= max_height:
+            return image_data
+
+        if pyvips is not None and dimensions is not None:
+            # libvips shrinks JPEGs during decoding and streams the pixel data, which is
+            # several times faster than the Pillow path below (dimensions could be
+            # determined, so the image is PNG or JPEG)
+            target_format = '.png' if image_data.startswith(b'\x89PNG') else '.jpg[Q=85]'
+            try:
+                image = pyvips.Image.thumbnail_buffer(
+                    image_data, max_width, height=max_height, size='down')
+                return image.write_to_buffer(target_format)
+            except pyvips.Error as err:
+                self._logger.warning('Unable to downscale image with pyvips: %s', err)
+
+        # Pillow is imported lazily, most runs never touch an image
+        from PIL import Image  # noqa: PLC0415
+
         try:
             image_data_bytes = io.BytesIO(image_data)
             image = Image.open(image_data_bytes)
             if image.size[0] > max_width or image.size[1] > max_height:
-                image.thumbnail((max_width, max_height))
+                # let the JPEG decoder already scale down during decoding and use the
+                # cheaper bilinear resampling, mail attachment quality is good enough
+                image.draft(image.mode, (max_width, max_height))
+                image.thumbnail((max_width, max_height), Image.Resampling.BILINEAR)
                 result = io.BytesIO()
                 image.save(result, image.format)
                 return result.getvalue()
@@ -828,6 +1210,32 @@ Poll ({poll.votes_count} votes so far, expires at {expires_at}):
 
         return image_data
 
+    @staticmethod
+    def _peek_image_dimensions(image_data):
+        """
+        Read the image dimensions directly from the PNG or JPEG header,
+        return None if they cannot be determined
+        """
+        if image_data[:8] == b'\x89PNG\r\n\x1a\n' and image_data[12:16] == b'IHDR':
+            if len(image_data) < 24:
+                return None  # truncated header, let Pillow decide what to do with it
+            return struct.unpack('>II', image_data[16:24])
+
+        if image_data[:2] == b'\xff\xd8':  # JPEG
+            offset = 2
+            while offset + 9 < len(image_data):
+                if image_data[offset] != 0xFF:
+                    break
+                marker = image_data[offset + 1]
+                # SOF markers carry the dimensions (except DHT, JPG and DAC)
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack('>HH', image_data[offset + 5:offset + 9])
+                    return width, height
+                segment_length = struct.unpack('>H', image_data[offset + 2:offset + 4])[0]
+                offset += 2 + segment_length
+
+        return None
+
     def _factor_mail_headers(self, toot):
         fqdn = socket.getfqdn()
         hostname = toot.get_hostname()
@@ -842,7 +1250,43 @@ Poll ({poll.votes_count} votes so far, expires at {expires_at}):
 
         return headers
 
-    def _send_mail(self, mail_from, subject, message, date, files=None, headers=None):
+    def _start_mail_worker(self):
+        # deliver the mails from a separate thread so SMTP I/O overlaps with
+        # fetching and processing the next toots
+        self._mail_queue = queue.Queue()
+        self._mail_worker_thread = threading.Thread(target=self._process_mail_queue, daemon=True)
+        self._mail_worker_thread.start()
+
+    def _stop_mail_worker(self):
+        if self._mail_worker_thread is None:
+            return
+
+        self._mail_queue.put(None)  # sentinel to signal the worker to finish
+        self._mail_worker_thread.join()
+        self._mail_worker_thread = None
+
+    def _process_mail_queue(self):
+        while True:
+            mail = self._mail_queue.get()
+            try:
+                if mail is None:
+                    break
+                toots = mail[0]
+                self._deliver_mail(*mail[1:])
+                # remember the toots (including a boosting toot) only after the
+                # mail really went out so failed deliveries are retried next run
+                for toot in toots:
+                    self._add_toot_to_toot_state(toot)
+            except Exception as exc:
+                self._mail_delivery_errors += 1
+                self._log_error(exc, 'An error occurred while sending mail: %s', exc)
+            finally:
+                self._mail_queue.task_done()
+
+    def _send_mail(self, toots, mail_from, subject, message, date, files=None, headers=None):
+        self._mail_queue.put((toots, mail_from, subject, message, date, files, headers))
+
+    def _deliver_mail(self, mail_from, subject, message, date, files=None, headers=None):
         if files:
             msg = MIMEMultipart()
             msg.attach(MIMEText(message))
@@ -867,15 +1311,57 @@ Poll ({poll.votes_count} votes so far, expires at {expires_at}):
             for key, value in headers.items():
                 msg.add_header(key, value)
 
-        smtp = smtplib.SMTP(self._mail_server_hostname, self._mail_server_port)
-        smtp.sendmail(self._mail_recipient, recipients, msg.as_string())
-        smtp.quit()
+        # send_message() streams the message to the socket instead of materializing
+        # the whole base64 encoded payload as one string like as_string() did
+        smtp = self._get_smtp_connection()
+        try:
+            smtp.send_message(msg, from_addr=self._mail_recipient, to_addrs=recipients)
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError):
+            # the server may drop the connection between mails, reconnect and retry once
+            self._close_smtp_connection()
+            smtp = self._get_smtp_connection()
+            smtp.send_message(msg, from_addr=self._mail_recipient, to_addrs=recipients)
+
+    def _get_smtp_connection(self):
+        # reuse the SMTP connection across mails, reconnect if the server dropped it
+        if self._smtp is not None:
+            try:
+                self._smtp.noop()
+            except (smtplib.SMTPException, OSError):
+                self._smtp = None
+
+        if self._smtp is None:
+            self._smtp = smtplib.SMTP(self._mail_server_hostname, self._mail_server_port)
+
+        return self._smtp
+
+    def _close_smtp_connection(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
 
     def _add_toot_to_toot_state(self, toot):
         uid = toot.get_uid()
         toot_uri = toot.uri.lower()
-        user = self._toot_state.setdefault(uid, {'toots': []})
-        user['toots'].append(toot_uri)
+        with self._toot_state_lock:
+            user = self._toot_state.setdefault(uid, {'toots': set()})
+            user['toots'].add(toot_uri)
+            self._toot_state_dirty = True
+            self._append_toot_state_journal(uid, toot_uri)
+
+    def _append_toot_state_journal(self, uid, toot_uri):
+        # must be called with the state lock held and only after the toot's mail
+        # was delivered; one fsynced line per mailed toot keeps the dedup
+        # information crash safe between the full state writes
+        if self._journal_file is None:
+            self._journal_file = open(self._journal_file_path, 'a', encoding='utf-8')
+
+        self._journal_file.write(json.dumps({'uid': uid, 'uri': toot_uri}) + '\n')
+        self._journal_file.flush()
+        os.fsync(self._journal_file.fileno())
 
     def _process_hashtag(self, hashtag, hostname):
         try:
@@ -906,15 +1392,50 @@ Poll ({poll.votes_count} votes so far, expires at {expires_at}):
         toots = [Toot(toot_dict) for toot_dict in toot_dicts]
         return toots
 
-    def _pause(self):
-        sleep(randint(3, 10))  # noqa: S311
+    def _pause(self, hostname=None):
+        # a short pause is enough while the instance still has plenty of rate limit
+        # budget, _pace() waits adaptively once the budget runs low
+        ratelimit = self._ratelimits.get(hostname) if hostname else None
+        if ratelimit and ratelimit[0] >= RATE_LIMIT_MINIMUM_REMAINING:
+            sleep(randint(1, 3))  # noqa: S311
+        else:
+            sleep(randint(3, 10))  # noqa: S311
 
     def _write_toot_state(self):
-        with open(self._state_file_path, 'w', encoding='utf-8') as state_file:
-            json.dump(self._toot_state, state_file, indent=2)
-
-    def _remove_lock(self):
-        self._lock_file_path.unlink()
+        # skip the write completely if nothing changed, e.g. when all toots were skipped
+        if not self._toot_state_dirty:
+            return
+
+        # convert the in-memory sets back to sorted lists as JSON has no set type and
+        # keep only the newest entries per user to bound the state file size, the URIs
+        # sort roughly chronologically as they contain ascending status ids
+        toot_state = {
+            uid: dict(user, toots=sorted(user['toots'])[-self._state_maximum_toots_per_user:])
+            for uid, user in self._toot_state.items()}
+        if orjson is not None:
+            serialized = orjson.dumps(toot_state, option=orjson.OPT_INDENT_2)
+        else:
+            serialized = json.dumps(toot_state, indent=2).encode('utf-8')
+
+        # write to a temporary file and move it into place so the state file
+        # is never left truncated
+        tmp_file_path = self._state_file_path.with_suffix('.tmp')
+        with open(tmp_file_path, 'wb') as state_file:
+            state_file.write(serialized)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(tmp_file_path, self._state_file_path)
+
+        # the consolidated state now contains everything, drop the journal
+        if self._journal_file is not None:
+            self._journal_file.close()
+            self._journal_file = None
+        self._journal_file_path.unlink(missing_ok=True)
+
+    def _release_lock(self):
+        if self._lock_file is not None:
+            self._lock_file.close()  # closing the file releases the lock
+            self._lock_file = None
 
 
 def main():